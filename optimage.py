@@ -12,21 +12,80 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import argparse
+import array
 import collections
+import concurrent.futures
 import contextlib
+import functools
 import logging
 import os
 import os.path
 import shutil
+import stat
 import subprocess
 import sys
 import tempfile
+import types
 
-from PIL import Image
+# Pillow, numpy and argparse are slow to import, so they are imported only when
+# needed. This matters when the command is run once per file.
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy_available():
+    """Check whether numpy is installed."""
+    try:
+        import numpy  # pylint: disable=unused-import
+    except ImportError:  # pragma: no cover
+        return False
+    return True
+
+
+def _pixels_are_equal_numpy(img1_bytes, img2_bytes):
+    """Vectorized version of _pixels_are_equal_python."""
+    import numpy
+
+    if len(img1_bytes) != len(img2_bytes):
+        return False
+
+    # Compare whole pixels as 32 bit integers, and read the alpha channel from
+    # the byte view, which does not depend on the endianness. Only the pixels
+    # that differ need their alpha channel checked.
+    pixels1 = numpy.frombuffer(img1_bytes, dtype=numpy.uint32)
+    pixels2 = numpy.frombuffer(img2_bytes, dtype=numpy.uint32)
+    different = numpy.flatnonzero(pixels1 != pixels2)
+
+    alpha1 = numpy.frombuffer(img1_bytes, dtype=numpy.uint8)[3::4][different]
+    alpha2 = numpy.frombuffer(img2_bytes, dtype=numpy.uint8)[3::4][different]
+
+    return not numpy.any((alpha1 != 0) | (alpha2 != 0))
+
+
+def _pixels_are_equal_python(img1_bytes, img2_bytes):
+    """Compare RGBA buffers ignoring the RGB value of transparent pixels."""
+    if len(img1_bytes) != len(img2_bytes):
+        return False
+
+    # Compare whole pixels as 32 bit integers. The position of the alpha byte
+    # within the integer depends on the endianness.
+    alpha_shift = 24 if sys.byteorder == 'little' else 0
+    pixels1 = array.array('I', img1_bytes)
+    pixels2 = array.array('I', img2_bytes)
+    for pixel1, pixel2 in zip(pixels1, pixels2):
+        if pixel1 == pixel2:
+            continue
+
+        if ((pixel1 >> alpha_shift) & 0xFF or
+                (pixel2 >> alpha_shift) & 0xFF):
+            return False
+
+    return True
 
 
 def _images_are_equal(filename1, filename2):
+    from PIL import Image
+    from PIL import ImageChops
+
     # We need to convert both images to the same format, as the resulting one
     # may have lost the alpha channel (alpha=255) or may be now indexed
     # (L or P mode).
@@ -35,23 +94,22 @@ def _images_are_equal(filename1, filename2):
     img1 = Image.open(filename1).convert('RGBA')
     img2 = Image.open(filename2).convert('RGBA')
 
-    img1_bytes = img1.tobytes()
-    img2_bytes = img2.tobytes()
-
-    if len(img1_bytes) != len(img2_bytes):
+    if img1.size != img2.size:
         return False
 
-    null_byte = 0
-    for i in range(len(img1_bytes) // 4):
-        pos = 4 * i
-        if (img1_bytes[pos + 3] == null_byte and
-                img2_bytes[pos + 3] == null_byte):
-            continue
+    # Find the region where the images differ. Note that getbbox on an RGBA
+    # image only considers the alpha channel, so we first merge all the bands.
+    difference = ImageChops.difference(img1, img2)
+    bbox = functools.reduce(ImageChops.lighter, difference.split()).getbbox()
+    if bbox is None:
+        return True
 
-        if img1_bytes[pos:pos + 4] != img2_bytes[pos:pos + 4]:
-            return False
+    img1_bytes = img1.crop(bbox).tobytes()
+    img2_bytes = img2.crop(bbox).tobytes()
 
-    return True
+    if _numpy_available():
+        return _pixels_are_equal_numpy(img1_bytes, img2_bytes)
+    return _pixels_are_equal_python(img1_bytes, img2_bytes)
 
 
 # Magic numbers taken from https://en.wikipedia.org/wiki/List_of_file_signatures
@@ -61,7 +119,8 @@ _PNG_MAGIC_NUMBER = b'\x89\x50\x4E\x47\x0D\x0A\x1A\x0A'
 
 def _check_magic_number(filename, magic_number):
     """Check whether the filename starts with the provided magic number."""
-    with open(filename, 'rb') as f:
+    # Only a few bytes are needed, so avoid filling a whole read buffer.
+    with open(filename, 'rb', buffering=0) as f:
         return f.read(len(magic_number)) == magic_number
 
 
@@ -75,26 +134,21 @@ def _is_png(filename):
     return _check_magic_number(filename, _PNG_MAGIC_NUMBER)
 
 
-def _get_temporary_filename(prefix='tmp'):
-    temp_file = tempfile.NamedTemporaryFile(prefix=prefix)
-    temp_name = temp_file.name
-    temp_file.close()
-
-    return temp_name
-
-
 @contextlib.contextmanager
 def _temporary_filenames(total):
-    """Context manager to create temporary files and remove them after use."""
-    temp_files = [_get_temporary_filename('optimage-') for i in range(total)]
-    yield temp_files
-    for temp_file in temp_files:
-        try:
-            os.remove(temp_file)
-        except OSError:
-            # Continue in case we could not remove the file. One reason is that
-            # the fail was never created.
-            pass
+    """Context manager to create temporary files and remove them after use.
+
+    The files are not created, but their names are unique, as they live in a
+    private directory created just for them.
+    """
+    temp_dir = tempfile.mkdtemp(prefix='optimage-')
+    temp_files = [os.path.join(temp_dir, str(i)) for i in range(total)]
+    try:
+        yield temp_files
+    finally:
+        # Removing the whole directory also takes care of files that were never
+        # created, and of any leftovers from the compressors.
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 
 class InvalidExtension(Exception):
@@ -105,9 +159,25 @@ class MissingBinary(FileNotFoundError):
     """The binary does not exist."""
 
 
+# Absolute paths of the binaries, resolved on first use.
+_binary_paths = {}
+
+
+def _find_binary(name):
+    """Return the absolute path of the binary, or None if it was not found."""
+    if name not in _binary_paths:
+        _binary_paths[name] = shutil.which(name)
+    return _binary_paths[name]
+
+
 def _call_binary(args):
+    # Compressors are run concurrently from several threads, so this function
+    # must remain thread-safe.
     try:
-        return subprocess.check_output(args, stderr=subprocess.STDOUT)
+        # Use the cached path of the binary, so PATH is not searched again on
+        # every call. If it was not found, let subprocess report the error.
+        return subprocess.check_output(args, executable=_find_binary(args[0]),
+                                       stderr=subprocess.STDOUT)
     except FileNotFoundError as error:
         raise MissingBinary(error.errno, 'binary not found', args[0])
 
@@ -135,10 +205,14 @@ def _jpegtran(input_filename, output_filename):
 def _jpegoptim(input_filename, output_filename):
     # jpegoptim replaces the input file with the compressed version, so we first
     # need to copy the input file to the output file.
-    shutil.copy(input_filename, output_filename)
+    shutil.copyfile(input_filename, output_filename)
     _call_binary(['jpegoptim', '--strip-all', '--quiet', output_filename])
 
 
+_JPEG_COMPRESSORS = (_jpegtran, _jpegoptim)
+_PNG_COMPRESSORS = (_pngcrush, _optipng, _zopflipng)
+
+
 _CompressorResult = collections.namedtuple('_CompressorResult',
                                            ['size', 'filename', 'compressor'])
 
@@ -156,22 +230,61 @@ def _process(compressor, input_filename, output_filename):
     return _CompressorResult(result_size, output_filename, compressor.__name__)
 
 
-def _compress_with(input_filename, output_filename, compressors):
+def _compress_with(input_filename, output_filename, compressors,
+                   input_size=None):
     """Helper function to compress an image with several compressors.
 
     In case the compressors do not improve the filesize or in case the resulting
     image is not equivalent to the source, then the output will be a copy of the
     input.
+
+    The compressors are independent of each other, so they are run
+    concurrently, each one writing to its own temporary file.
+
+    The size of the input can be given in input_size, to avoid computing it
+    again.
+
+    Returns:
+      The size of the output file.
     """
+    if input_size is None:
+        input_size = os.path.getsize(input_filename)
+
     with _temporary_filenames(len(compressors)) as temp_filenames:
-        results = []
-        for compressor, temp_filename in zip(compressors, temp_filenames):
-            results.append(_process(compressor, input_filename, temp_filename))
-        best_result = min(results)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(compressors)) as executor:
+            futures = [executor.submit(_process, compressor, input_filename,
+                                       temp_filename)
+                       for compressor, temp_filename in zip(compressors,
+                                                            temp_filenames)]
+            # Keep only the best result so far, removing the other files as
+            # soon as they are known to be worse.
+            best_result = None
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    # The result is discarded. The errors are re-raised below,
+                    # in compressor order, once all the compressors finish.
+                    break
+
+                result = future.result()
+                # Break ties by compressor name, so the result is deterministic.
+                if best_result is None or ((result.size, result.compressor) <
+                                           (best_result.size,
+                                            best_result.compressor)):
+                    if best_result is not None:
+                        os.remove(best_result.filename)
+                    best_result = result
+                else:
+                    os.remove(result.filename)
+
+        # Report the error of the first failing compressor, in order.
+        for future in futures:
+            future.result()
+
         os.rename(best_result.filename, output_filename)
 
         best_compressor = best_result.compressor
-        if best_result.size >= os.path.getsize(input_filename):
+        if best_result.size >= input_size:
             best_compressor = None
 
         if (best_compressor is not None and
@@ -181,11 +294,15 @@ def _compress_with(input_filename, output_filename, compressors):
             best_compressor = None
 
         if best_compressor is None:
-            shutil.copy(input_filename, output_filename)
+            shutil.copyfile(input_filename, output_filename)
 
     logging.info('%s: best compressor for "%s"', best_compressor,
                  input_filename)
 
+    if best_compressor is None:
+        return input_size
+    return best_result.size
+
 
 def jpeg_compressor(input_filename, output_filename):
     """Loslessly recompress a JPEG.
@@ -196,7 +313,7 @@ def jpeg_compressor(input_filename, output_filename):
     if not _is_jpeg(input_filename):
         raise InvalidExtension()
 
-    _compress_with(input_filename, output_filename, [_jpegtran, _jpegoptim])
+    _compress_with(input_filename, output_filename, _JPEG_COMPRESSORS)
 
 
 def png_compressor(input_filename, output_filename):
@@ -208,18 +325,27 @@ def png_compressor(input_filename, output_filename):
     if not _is_png(input_filename):
         raise InvalidExtension()
 
-    _compress_with(input_filename, output_filename,
-                   [_pngcrush, _optipng, _zopflipng])
+    _compress_with(input_filename, output_filename, _PNG_COMPRESSORS)
 
 
+# Maps each extension to the function validating the file contents and to the
+# compressors to use.
 _EXTENSION_MAPPING = {
-    '.jpeg': jpeg_compressor,
-    '.jpg': jpeg_compressor,
-    '.png': png_compressor,
+    '.jpeg': (_is_jpeg, _JPEG_COMPRESSORS),
+    '.jpg': (_is_jpeg, _JPEG_COMPRESSORS),
+    '.png': (_is_png, _PNG_COMPRESSORS),
 }
 
 
 def _parse_argv(argv):
+    # Fast path for the common "optimage FILENAME" invocation, which does not
+    # need argparse. The defaults must match the ones of the parser below.
+    if len(argv) == 1 and not argv[0].startswith('-'):
+        return types.SimpleNamespace(replace=False, filenames=argv, output=None,
+                                     jobs=None, debug=False)
+
+    import argparse
+
     parser = argparse.ArgumentParser(
         description='Losslessly compress JPEG and PNG files.',
         prog='optimage')
@@ -227,50 +353,92 @@ def _parse_argv(argv):
         '--replace',
         action='store_true',
         help='replace the input file in case we can compress it')
-    parser.add_argument('filename',
+    parser.add_argument('filenames',
                         action='store',
-                        help='the filename to compress')
+                        nargs='+',
+                        metavar='filename',
+                        help='the filenames to compress')
     parser.add_argument('--output',
                         action='store',
                         help='the filename to compress',
                         required=False)
+    parser.add_argument('--jobs',
+                        action='store',
+                        type=int,
+                        help='the number of files to compress in parallel '
+                             '(defaults to the number of CPUs)',
+                        required=False)
     parser.add_argument('--debug', action='store_true', help=argparse.SUPPRESS)
     args = parser.parse_args(argv)
 
+    if args.output is not None and len(args.filenames) > 1:
+        parser.error('argument --output: not allowed with multiple filenames')
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('argument --jobs: must be a positive number')
+
     return args
 
 
-def main(argv):
-    args = _parse_argv(argv)
-    filename = args.filename
+def _optimize_file(filename, args):
+    """Compress a single file, returning the exit code of the command.
+
+    Unexpected errors are reported and turned into an exit code, so a single
+    file cannot abort the compression of the others.
+    """
+    if args.debug:
+        # Configure logging here, as this may run in a worker process, which
+        # does not inherit the configuration when it is spawned.
+        logging.basicConfig(level=logging.INFO,
+                            format='%(levelname)s: %(message)s')
+
+    # Pillow reports undecodable images with OSError, or SyntaxError for some
+    # broken PNG files.
+    try:
+        return _compress_file(filename, args)
+    except (OSError, SyntaxError) as error:
+        sys.stderr.write('Error when compressing {}: {}\n'.format(
+            filename, error))
+        return 8
 
-    if not os.path.isfile(filename):
+
+def _compress_file(filename, args):
+    """Helper function of _optimize_file doing the actual work."""
+    # A single stat tells both whether the file exists and its size.
+    try:
+        file_stat = os.stat(filename)
+    except OSError:
+        file_stat = None
+
+    if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
         sys.stderr.write(
             '{} is not an image file\n'.format(filename))
         return 3
 
+    # Tell the files apart when several are compressed at once.
+    prefix = '{}: '.format(filename) if len(args.filenames) > 1 else ''
+
     _, extension = os.path.splitext(filename)
     extension = extension.lower()
-    compressor = _EXTENSION_MAPPING.get(extension)
-    if compressor is None:
+    if extension not in _EXTENSION_MAPPING:
         sys.stderr.write(
-            'No lossless compressor defined for extension "{}"\n'.format(
-                extension))
+            '{}No lossless compressor defined for extension "{}"\n'.format(
+                prefix, extension))
         return 4
 
-    if args.debug:
-        logging.basicConfig(level=logging.INFO,
-                            format='%(levelname)s: %(message)s')
+    is_valid, compressors = _EXTENSION_MAPPING[extension]
+    if not is_valid(filename):
+        sys.stderr.write(
+            '{} is not a "{}" file. Please correct the extension\n'.format(
+                filename, extension))
+        return 5
+
+    original_size = file_stat.st_size
 
     with _temporary_filenames(1) as temp_filenames:
         output_filename = temp_filenames[0]
         try:
-            compressor(filename, output_filename)
-        except InvalidExtension as error:
-            sys.stderr.write(
-                '{} is not a "{}" file. Please correct the extension\n'.format(
-                    filename, extension))
-            return 5
+            new_size = _compress_with(filename, output_filename, compressors,
+                                      original_size)
         except MissingBinary as error:
             sys.stderr.write(
                 'The executable "{}" was not found. '.format(error.filename) +
@@ -285,8 +453,6 @@ def main(argv):
             sys.stderr.write(error.output.decode('utf-8'))
             return 7
 
-        original_size = os.path.getsize(filename)
-        new_size = os.path.getsize(output_filename)
         reduction = original_size - new_size
         reduction_percentage = reduction * 100 / original_size
         savings = 'savings: {} bytes = {:.2f}%'.format(
@@ -299,15 +465,15 @@ def main(argv):
                 else:
                     destination = args.output
 
-                shutil.copy(output_filename, destination)
+                shutil.copyfile(output_filename, destination)
 
-                print('File was losslessly compressed to {} bytes ({})'.format(
-                    new_size, savings))
+                print('{}File was losslessly compressed to {} bytes ({})'.format(
+                    prefix, new_size, savings))
                 return 0
             else:
                 print(
-                    'File can be losslessly compressed to {} bytes ({})'.format(
-                        new_size, savings))
+                    '{}File can be losslessly compressed to {} bytes ({})'.format(
+                        prefix, new_size, savings))
                 print('Replace it by running either:')
                 print('  optimage --replace {}'.format(filename))
                 print('  optimage --output <FILENAME> {}'.format(filename))
@@ -316,6 +482,26 @@ def main(argv):
     return 0
 
 
+def main(argv):
+    args = _parse_argv(argv)
+
+    # Files are independent of each other, so they are compressed in separate
+    # processes. The exit code is the highest among all files.
+    if len(args.filenames) == 1 or args.jobs == 1:
+        exit_codes = [_optimize_file(filename, args)
+                      for filename in args.filenames]
+    else:
+        # Do not start more workers than there are files.
+        jobs = min(args.jobs or os.cpu_count() or 1, len(args.filenames))
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs) as executor:
+            exit_codes = list(executor.map(
+                _optimize_file, args.filenames,
+                [args] * len(args.filenames)))
+
+    return max(exit_codes)
+
+
 __all__ = ('jpeg_compressor', 'png_compressor')
 
 
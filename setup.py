@@ -29,6 +29,7 @@ setup(
     scripts=['scripts/optimage'],
     setup_requires=['pytest-runner'],
     install_requires=['Pillow'],
+    extras_require={'numpy': ['numpy']},
     tests_require=['pytest', 'pytest-cov', 'pytest-catchlog'],
     classifiers=[
         'Development Status :: 3 - Alpha',
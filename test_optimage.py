@@ -1,27 +1,38 @@
 import os.path
+import shutil
 import subprocess
+import sys
 
 import pytest
+from PIL import Image
 
 import optimage
 
 # pylint: disable=protected-access
 
 
-def test_get_temporary_filename_prefix():
-    tmp_filename = optimage._get_temporary_filename(prefix='prefix')
-    assert os.path.basename(tmp_filename).startswith('prefix')
-    assert not os.path.exists(tmp_filename)
-
-
 def test_temporary_filenames():
     with optimage._temporary_filenames(3) as temp_filenames:
         assert len(temp_filenames) == 3
+        assert len(set(temp_filenames)) == 3
+        for temp_filename in temp_filenames:
+            assert not os.path.exists(temp_filename)
         with open(temp_filenames[1], 'w') as f:
             f.write('foo')
 
-    for temp_filename in temp_filenames:
-        assert not os.path.exists(temp_filename)
+    temp_dir = os.path.dirname(temp_filenames[0])
+    assert os.path.basename(temp_dir).startswith('optimage-')
+    assert not os.path.exists(temp_dir)
+
+
+def test_temporary_filenames_error():
+    with pytest.raises(ValueError):
+        with optimage._temporary_filenames(1) as temp_filenames:
+            with open(temp_filenames[0], 'w') as f:
+                f.write('foo')
+            raise ValueError()
+
+    assert not os.path.exists(os.path.dirname(temp_filenames[0]))
 
 
 @pytest.mark.parametrize('filename, expected_result', [
@@ -50,6 +61,7 @@ def test_check_magic_number(filename, magic, expected_result):
 
 
 @pytest.mark.parametrize('filename1, filename2, expected_result', [
+    ('test_data/valid1.png', 'test_data/valid1.png', True),
     ('test_data/valid1.png', 'test_data/valid1_compressed.png', True),
     ('test_data/valid1.png', 'test_data/valid1.jpg', True),
     ('test_data/valid1.png', 'test_data/valid2.png', False),
@@ -57,17 +69,108 @@ def test_check_magic_number(filename, magic, expected_result):
     # Issue 4 (https://github.com/sk-/optimage/issues/4):
     # Images with alpha channel 0 should be equal regardless of the RGB values
     ('test_data/zopfli_issue20_original.png', 'test_data/zopfli_issue20_vs2013.png', True),
+    ('test_data/zopfli_issue20_original.png', 'test_data/valid1.png', False),
 ])
 def test_images_are_equal(filename1, filename2, expected_result):
     assert optimage._images_are_equal(filename1, filename2) == expected_result
 
 
+@pytest.mark.parametrize('color1, color2, expected_result', [
+    ((1, 2, 3, 255), (1, 2, 3, 255), True),
+    ((1, 2, 3, 255), (1, 2, 4, 255), False),
+    ((1, 2, 3, 0), (4, 5, 6, 0), True),
+])
+def test_images_are_equal_rgba(color1, color2, expected_result, tmpdir):
+    filename1 = str(tmpdir.join('image1.png'))
+    filename2 = str(tmpdir.join('image2.png'))
+    Image.new('RGBA', (4, 4), color1).save(filename1)
+    Image.new('RGBA', (4, 4), color2).save(filename2)
+
+    assert optimage._images_are_equal(filename1, filename2) == expected_result
+
+
+def test_images_are_equal_without_numpy(monkeypatch):
+    monkeypatch.setattr(optimage, '_numpy_available', lambda: False)
+    assert optimage._images_are_equal('test_data/valid1.png',
+                                      'test_data/valid1_compressed.png')
+    assert not optimage._images_are_equal('test_data/valid1.png',
+                                          'test_data/valid2.png')
+
+
+@pytest.mark.parametrize('pixels_are_equal', [
+    optimage._pixels_are_equal_python,
+    pytest.param(optimage._pixels_are_equal_numpy,
+                 marks=pytest.mark.skipif(not optimage._numpy_available(),
+                                          reason='numpy not available')),
+])
+@pytest.mark.parametrize('img1_bytes, img2_bytes, expected_result', [
+    (b'\x01\x02\x03\xff', b'\x01\x02\x03\xff', True),
+    (b'\x01\x02\x03\xff', b'\x01\x02\x04\xff', False),
+    (b'\x01\x02\x03\xff', b'\x01\x02\x03\xfe', False),
+    (b'\x01\x02\x03\x00', b'\x04\x05\x06\x00', True),
+    (b'\x01\x02\x03\x00', b'\x01\x02\x03\x01', False),
+    (b'\x01\x02\x03\x00\x01\x02\x03\xff',
+     b'\x04\x05\x06\x00\x01\x02\x03\xff', True),
+    (b'\x01\x02\x03\xff', b'\x01\x02\x03\xff\x01\x02\x03\xff', False),
+])
+def test_pixels_are_equal(pixels_are_equal, img1_bytes, img2_bytes,
+                          expected_result):
+    assert pixels_are_equal(img1_bytes, img2_bytes) == expected_result
+
+
+def test_find_binary(monkeypatch):
+    calls = []
+
+    def mock_which(name):
+        calls.append(name)
+        return '/bin/' + name if name == 'found' else None
+
+    monkeypatch.setattr(shutil, 'which', mock_which)
+    monkeypatch.setattr(optimage, '_binary_paths', {})
+
+    assert optimage._find_binary('found') == '/bin/found'
+    assert optimage._find_binary('found') == '/bin/found'
+    assert optimage._find_binary('missing') is None
+    assert optimage._find_binary('missing') is None
+    assert calls == ['found', 'missing']
+
+
+def test_call_binary_uses_absolute_path(monkeypatch):
+    monkeypatch.setattr(optimage, '_binary_paths', {})
+    optimage._call_binary(['true'])
+    assert os.path.isabs(optimage._binary_paths['true'])
+
+
+def test_lazy_imports():
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys, optimage; '
+        'optimage._parse_argv(["foo.png"]); '
+        'print(" ".join(sorted(sys.modules)))'])
+    modules = output.decode('utf-8').split()
+    assert 'PIL' not in modules
+    assert 'numpy' not in modules
+    assert 'argparse' not in modules
+
+
+def test_parse_argv_fast_path():
+    assert (vars(optimage._parse_argv(['foo.png'])) ==
+            vars(optimage._parse_argv(['--', 'foo.png'])))
+
+
 class TestCallBinary:
     cmd_args = ['cmd', 'arg1', 'arg2']
+    cmd_path = '/path/to/cmd'
+
+    @pytest.fixture(autouse=True)
+    def binary_paths(self, monkeypatch):
+        monkeypatch.setattr(optimage, '_binary_paths',
+                            {'cmd': self.cmd_path})
 
     def test_success(self, monkeypatch):
-        def mock_check_output(args, stderr=None):
+        def mock_check_output(args, executable=None, stderr=None):
             assert args == self.cmd_args
+            assert executable == self.cmd_path
             assert stderr == subprocess.STDOUT
             return ''
 
@@ -75,7 +178,7 @@ class TestCallBinary:
         optimage._call_binary(self.cmd_args)
 
     def test_missing_binary(self, monkeypatch):
-        def mock_check_output(args, stderr=None):
+        def mock_check_output(args, executable=None, stderr=None):
             assert args == self.cmd_args
             assert stderr == subprocess.STDOUT
             raise FileNotFoundError(2, 'file not found', None)
@@ -87,7 +190,7 @@ class TestCallBinary:
         assert excinfo.value.filename == self.cmd_args[0]
 
     def test_cmd_error(self, monkeypatch):
-        def mock_check_output(args, stderr=None):
+        def mock_check_output(args, executable=None, stderr=None):
             assert args == self.cmd_args
             assert stderr == subprocess.STDOUT
             raise subprocess.CalledProcessError(1, args)
@@ -96,4 +199,80 @@ class TestCallBinary:
         with pytest.raises(subprocess.CalledProcessError):
             optimage._call_binary(self.cmd_args)
 
+
+def _copy_compressor(source_filename):
+    def compressor(input_filename, output_filename):
+        shutil.copy(source_filename, output_filename)
+    compressor.__name__ = os.path.basename(source_filename)
+    return compressor
+
+
+@pytest.mark.parametrize('compressed_filenames, expected_filename', [
+    (['valid1.png', 'valid1_compressed.png'], 'valid1_compressed.png'),
+    (['valid1_compressed.png', 'valid1.png'], 'valid1_compressed.png'),
+    (['valid1.png', 'valid1.png'], 'valid1.png'),
+    # Smaller, but not equivalent to the input.
+    (['valid2_compressed.png'], 'valid1.png'),
+])
+def test_compress_with(compressed_filenames, expected_filename, tmpdir):
+    compressors = [_copy_compressor(os.path.join('test_data', filename))
+                   for filename in compressed_filenames]
+    output_filename = str(tmpdir.join('output.png'))
+
+    output_size = optimage._compress_with('test_data/valid1.png',
+                                          output_filename, compressors)
+
+    assert output_size == os.path.getsize(output_filename)
+    with open(output_filename, 'rb') as output_file:
+        with open(os.path.join('test_data', expected_filename), 'rb') as f:
+            assert output_file.read() == f.read()
+
+
+def test_compress_with_removes_worse_results(tmpdir, monkeypatch):
+    remaining_filenames = []
+    rename = os.rename
+
+    def mock_rename(src, dst):
+        remaining_filenames.extend(os.listdir(os.path.dirname(src)))
+        rename(src, dst)
+
+    monkeypatch.setattr(os, 'rename', mock_rename)
+    compressors = [_copy_compressor(os.path.join('test_data', filename))
+                   for filename in ['valid1.png', 'valid1_compressed.png',
+                                    'valid1.png']]
+    optimage._compress_with('test_data/valid1.png',
+                            str(tmpdir.join('output.png')), compressors)
+
+    assert len(remaining_filenames) == 1
+
+
+@pytest.mark.parametrize('compressor, compressors_name, filename', [
+    (optimage.png_compressor, '_PNG_COMPRESSORS', 'valid1.png'),
+    (optimage.jpeg_compressor, '_JPEG_COMPRESSORS', 'valid3.jpg'),
+])
+def test_compressor(compressor, compressors_name, filename, tmpdir,
+                    monkeypatch):
+    base, extension = os.path.splitext(filename)
+    compressed_filename = os.path.join('test_data',
+                                       base + '_compressed' + extension)
+    monkeypatch.setattr(optimage, compressors_name,
+                        (_copy_compressor(compressed_filename),))
+    output_filename = str(tmpdir.join('output' + extension))
+
+    assert compressor(os.path.join('test_data', filename),
+                      output_filename) is None
+
+    with open(output_filename, 'rb') as output_file:
+        with open(compressed_filename, 'rb') as f:
+            assert output_file.read() == f.read()
+
+
+@pytest.mark.parametrize('compressor, filename', [
+    (optimage.png_compressor, 'test_data/valid1.jpg'),
+    (optimage.jpeg_compressor, 'test_data/valid1.png'),
+])
+def test_compressor_invalid_extension(compressor, filename, tmpdir):
+    with pytest.raises(optimage.InvalidExtension):
+        compressor(filename, str(tmpdir.join('output')))
+
 # TODO(skreft): test compressors
@@ -1,3 +1,4 @@
+import concurrent.futures
 import logging
 import os
 import shutil
@@ -18,9 +19,7 @@ def test_missing_filename(capsys):
         optimage.main([])
     assert excinfo.value.code == 2
     _, err = capsys.readouterr()
-    py3_error = 'error: the following arguments are required: filename'
-    py2_error = 'error: too few arguments'
-    assert py3_error in err or py2_error in err
+    assert 'error: the following arguments are required: filename' in err
 
 
 def test_input_is_directory(capsys):
@@ -37,6 +36,103 @@ def test_input_does_not_exist(capsys):
     assert err == 'test_data/nonexistent.png is not an image file\n'
 
 
+def test_output_with_multiple_files(capsys):
+    with pytest.raises(SystemExit) as excinfo:
+        optimage.main(['--output', 'foo.png', 'test_data/valid1.png',
+                       'test_data/valid2.png'])
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert 'not allowed with multiple filenames' in err
+
+
+@pytest.mark.parametrize('jobs', ['0', '-1'])
+def test_invalid_jobs(jobs, capsys):
+    with pytest.raises(SystemExit) as excinfo:
+        optimage.main(['--jobs', jobs, 'test_data/valid1.png'])
+    assert excinfo.value.code == 2
+    _, err = capsys.readouterr()
+    assert 'argument --jobs: must be a positive number' in err
+
+
+def test_multiple_files(capsys):
+    exit_code = optimage.main(['--jobs', '1', 'test_data/nonexistent.png',
+                               'test_data/valid1.gif'])
+    assert exit_code == 4
+    _, err = capsys.readouterr()
+    assert err == ('test_data/nonexistent.png is not an image file\n'
+                   'test_data/valid1.gif: No lossless compressor defined for '
+                   'extension ".gif"\n')
+
+
+def test_multiple_files_parallel():
+    exit_code = optimage.main(['test_data/valid1.gif',
+                               'test_data/nonexistent.png',
+                               'test_data/wrong_extension.png'])
+    assert exit_code == 5
+
+
+def test_multiple_files_jobs_capped(monkeypatch):
+    workers = []
+
+    class MockExecutor(concurrent.futures.ThreadPoolExecutor):
+        def __init__(self, max_workers):
+            workers.append(max_workers)
+            super().__init__(max_workers)
+
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor',
+                        MockExecutor)
+    exit_code = optimage.main(['--jobs', '64', 'test_data/valid1.gif',
+                               'test_data/nonexistent.png'])
+    assert exit_code == 4
+    assert workers == [2]
+
+
+def _write_garbage_png(input_filename, output_filename):
+    with open(output_filename, 'wb') as f:
+        f.write(optimage._PNG_MAGIC_NUMBER)
+
+
+def _raise_permission_error(filename):
+    raise PermissionError(13, 'Permission denied', filename)
+
+
+@pytest.mark.parametrize('mapping, expected_error', [
+    ((_raise_permission_error, ()), 'Permission denied'),
+    ((optimage._is_png, (_write_garbage_png,)), 'cannot identify image file'),
+])
+def test_multiple_files_error(mapping, expected_error, capsys, monkeypatch):
+    monkeypatch.setitem(optimage._EXTENSION_MAPPING, '.png', mapping)
+
+    exit_code = optimage.main(['--jobs', '1', 'test_data/valid1.png',
+                               'test_data/valid1.gif'])
+    assert exit_code == 8
+    _, err = capsys.readouterr()
+    assert err.startswith('Error when compressing test_data/valid1.png: ')
+    assert expected_error in err
+    assert err.endswith('test_data/valid1.gif: No lossless compressor defined '
+                        'for extension ".gif"\n')
+
+
+def test_multiple_files_parallel_compressed(capfd, tmpdir):
+    filenames = []
+    for filename in ['valid1.png', 'valid2.png', 'valid3.jpg']:
+        output_filename = str(tmpdir.join(filename))
+        shutil.copy(os.path.join('test_data', filename), output_filename)
+        filenames.append(output_filename)
+
+    exit_code = optimage.main(['--replace', '--jobs', '3'] + filenames)
+    assert exit_code == 0
+    out, err = capfd.readouterr()
+    assert err == ''
+
+    for filename in filenames:
+        assert '{}: File was losslessly compressed to'.format(filename) in out
+        original_filename = os.path.join('test_data',
+                                         os.path.basename(filename))
+        assert optimage._images_are_equal(original_filename, filename)
+        assert os.path.getsize(original_filename) > os.path.getsize(filename)
+
+
 def test_unsupported_extension(capsys):
     exit_code = optimage.main(['test_data/valid1.gif'])
     assert exit_code == 4
@@ -127,7 +223,7 @@ def test_output_file(filename, capsys, tmpdir):
 
 
 def test_binary_not_found(capsys, monkeypatch):
-    def mock_check_output(args, stderr=None):
+    def mock_check_output(args, executable=None, stderr=None):
         raise FileNotFoundError()
 
     monkeypatch.setattr(subprocess, 'check_output', mock_check_output)
@@ -138,7 +234,7 @@ def test_binary_not_found(capsys, monkeypatch):
 
 
 def test_commanderror(capsys, monkeypatch):
-    def mock_check_output(args, stderr=None):
+    def mock_check_output(args, executable=None, stderr=None):
         raise subprocess.CalledProcessError(1, args, 'custom error'.encode('utf-8'))
 
     monkeypatch.setattr(subprocess, 'check_output', mock_check_output)